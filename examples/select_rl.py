@@ -30,7 +30,7 @@ for brain_response in tqdm(scenario):
           f"sentiment: {brain_response['statement']['perspective']['_sentiment']} "
           f"emotion: {brain_response['statement']['perspective']['_emotion']}")
 
-    selector.reward_thought()
+    selector.reward_thought(brain_response)
     brain_response["thoughts"] = selector.select(brain_response)
     print(f"\tChosen thought: {list(brain_response['thoughts'].keys())[0]}")
 
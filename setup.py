@@ -31,6 +31,9 @@ setup(
     ],
     setup_requires=['flake8'],
     extras_require={
+        "orjson": [
+            'orjson',
+        ],
         "transformers": [
             'torch~=1.10.2',
             'transformers~=4.16.2',
@@ -6,20 +6,35 @@
 """
 
 import json
-import matplotlib.pyplot as plt
+import math
 import numpy as np
 import os
 import random
-from rdflib import ConjunctiveGraph
-from rdflib.extras.external_graph_libs import rdflib_to_networkx_multidigraph
 
 from cltl.thoughts.api import ThoughtSelector
 
-# from cltl.dialogue_evaluation.metrics.ontology_measures import get_avg_population
-# from cltl.dialogue_evaluation.metrics.graph_measures import get_avg_degree, get_sparseness, get_shortest_path
+try:
+    import orjson
+
+    def _dumps(data):
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+except ImportError:
+    def _dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _mean_scores(scores, idx, out):
+    """Computes the score of each action as the mean score of its elements, where the
+    elements of action a are scores[idx[a]] and rows of idx are padded with -1, into out.
+    """
+    mask = idx >= 0
+    return np.divide(np.where(mask, scores[idx], 0).sum(axis=1), mask.sum(axis=1), out=out)
 
 
 class UCB(ThoughtSelector):
+    # Version 2 counts include the initial pseudo-count of one, version 1 (unversioned) files do not
+    _FORMAT_VERSION = 2
+
     def __init__(self, brain, reward="Total triples", savefile=None, c=2, tmax=1e10):
         """Initializes an instance of the Upper Confidence Bound
         (UCB) reinforcement learning algorithm.
@@ -31,20 +46,34 @@ class UCB(ThoughtSelector):
 
         float t:          timestep
         float decay:      decay rate of exploration constant c
-        float Q:          stores the estimate of the expected reward for each action
-        float N:          stores the number of updates performed on each action
+        dict index:       maps each action element to its position in Q and N
+        array Q:          stores the estimate of the expected reward for each action element
+        array N:          stores the number of updates performed on each action element,
+                          starting at one for unseen elements (see _intern)
 
         returns: UCB object
         """
         super().__init__()
 
         # generic UBC parameters
-        self._Q = dict()
-        self._N = dict()
         self._t = 1
+        self._log_t = math.log(self._t)
         self._c = c
         self._decay = c / tmax
 
+        # value and count tables, grown on demand as elements are interned
+        self._index = dict()
+        self._cap = 64
+        self._size = 0
+        self._Q = np.zeros(self._cap)
+        self._N = np.zeros(self._cap, dtype=np.int64)
+
+        # cached element indices of previously seen actions
+        self._idx_cache = dict()
+
+        # action scores buffer reused across selections
+        self._score_buf = np.empty(64)
+
         # Include rewards according to the state of the brain
         self._state_evaluator = BrainEvaluator(brain, reward)
         self._log.debug(f"Brain state evaluator ready")
@@ -73,8 +102,43 @@ class UCB(ThoughtSelector):
 
     # Utils
 
+    @staticmethod
+    def _binary_files(filename):
+        """Derives the filenames of the binary utility tables from the JSON filename,
+        e.g. thoughts.npz and thoughts.meta.json for thoughts.json.
+
+        params
+        str filename: filename of the JSON file with utilities.
+
+        returns: filenames of the array file and of the metadata file
+        """
+        base = os.path.splitext(filename)[0]
+        return base + ".npz", base + ".meta.json"
+
+    def _load_metadata(self, metadata):
+        self._c = metadata["c"]
+        self._t = metadata["t"]
+        self._log_t = math.log(self._t)
+        self._decay = metadata["decay"]
+
+        return metadata.get("version", 1)
+
+    def _upgrade_counts(self, idx, version):
+        """Converts counts read from an older file format to the current one.
+        Version 1 counts exclude the initial pseudo-count, values are unaffected.
+
+        params
+        array idx:   indices of the loaded action elements
+        int version: format version of the file
+
+        returns: None
+        """
+        if version < 2:
+            self._N[idx] += 1
+
     def load(self, filename):
-        """Reads utility values from file.
+        """Reads utility values from file. The binary tables written by save_binary
+        are preferred over the JSON file when present and at least as recent.
 
         params
         str filename: filename of file with utilities.
@@ -84,19 +148,28 @@ class UCB(ThoughtSelector):
         if filename is None:
             return
 
+        npz_file, meta_file = self._binary_files(filename)
+        if os.path.isfile(npz_file) and os.path.isfile(meta_file) and \
+                (not os.path.isfile(filename) or os.path.getmtime(npz_file) >= os.path.getmtime(filename)):
+            self.load_binary(filename)
+            return
+
         if not os.path.isfile(filename):  # File exists?
-            self._log.warning(f"WARNING {filename.resolve()} does not yet exist")
+            self._log.warning(f"WARNING {os.path.abspath(filename)} does not yet exist")
             return
 
-        with open(filename, "r") as file:
+        with open(filename, "r", encoding="utf-8") as file:
             data = json.load(file)
-            self._c = data["metadata"]["c"]
-            self._t = data["metadata"]["t"]
-            self._decay = data["metadata"]["decay"]
+            version = self._load_metadata(data["metadata"])
 
+            idx = []
             for action, values in data["data"].items():
-                self._Q[action] = values["value"]
-                self._N[action] = values["count"]
+                i = self._intern(action)
+                self._Q[i] = values["value"]
+                self._N[i] = values["count"]
+                idx.append(i)
+
+            self._upgrade_counts(np.array(idx, dtype=np.int64), version)
 
     def save(self, filename):
         """Writes the value and uncertainty tables to a JSON file.
@@ -107,34 +180,120 @@ class UCB(ThoughtSelector):
         returns: None
         """
         # Format metadata (c, t, decay) and value estimates as JSON.
+        U = self._uncertainty(self._log_t)
         data = {
-            "metadata": {"c": self._c, "t": self._t, "decay": self._decay},
-            "data": dict(),
+            "metadata": {"c": self._c, "t": self._t, "decay": self._decay, "version": self._FORMAT_VERSION},
+            "data": {action: {"value": float(self._Q[i]), "count": int(self._N[i]), "uncertainty": float(U[i])}
+                     for action, i in self._index.items()},
         }
 
-        for action in self._Q.keys():
-            if self._N[action] > 0:
-                data["data"][action] = {
-                    "value": self._Q[action],
-                    "count": self._N[action],
-                    "uncertainty": self._uncertainty(action),
-                }
         # Write to file
-        with open(filename, "w") as file:
-            json.dump(data, file)
+        with open(filename, "wb") as file:
+            file.write(_dumps(data))
+
+    def load_binary(self, filename):
+        """Reads utility values from the binary tables written by save_binary.
+
+        params
+        str filename: filename of the JSON file with utilities, see _binary_files.
+
+        returns: None
+        """
+        npz_file, meta_file = self._binary_files(filename)
+
+        with open(meta_file, "r", encoding="utf-8") as file:
+            data = json.load(file)
+            version = self._load_metadata(data["metadata"])
+
+        with np.load(npz_file) as tables:
+            Q, N = tables["Q"], tables["N"]
+
+        # A partial save may leave the tables and the index out of sync
+        if not len(data["index"]) == len(Q) == len(N):
+            raise ValueError(f"{meta_file} lists {len(data['index'])} action elements but {npz_file} "
+                             f"holds {len(Q)} values and {len(N)} counts")
+
+        idx = np.array([self._intern(action) for action in data["index"]], dtype=np.int64)
+        self._Q[idx] = Q
+        self._N[idx] = N
+
+        self._upgrade_counts(idx, version)
+
+    def save_binary(self, filename):
+        """Writes the value and count tables as compressed NumPy arrays, with
+        the action elements and metadata in a small JSON file next to them.
+
+        params
+        str filename: filename of the JSON file with utilities, see _binary_files.
+
+        returns: None
+        """
+        npz_file, meta_file = self._binary_files(filename)
+
+        np.savez_compressed(npz_file, Q=self._Q[:self._size], N=self._N[:self._size])
+        with open(meta_file, "wb") as file:
+            file.write(_dumps({
+                "metadata": {"c": self._c, "t": self._t, "decay": self._decay, "version": self._FORMAT_VERSION},
+                "index": list(self._index),
+            }))
 
     # Learning
 
-    def _uncertainty(self, action):
-        """Computes the uncertainty associated with the current action
-        as the upper confidence bound of the current average.
+    def _uncertainty(self, log_t):
+        """Computes the uncertainty associated with each action (element)
+        as the upper confidence bound of its current average.
+
+        params
+        float log_t: logarithm of the current timestep
+
+        returns:     array with the uncertainty of each action element
+        """
+        return self._c * np.sqrt(log_t / self._N[:self._size])
+
+    def _intern(self, elem):
+        """Returns the position of an action element in the Q and N arrays,
+        adding unseen elements to the tables with a value of zero and a count of one.
+        Instead of forcing every element to be sampled once, unseen elements then
+        get the largest uncertainty bonus. The pseudo-count is not an observation:
+        the value of an element is the plain average of its rewards (see update_utility).
+
+        params
+        str elem: an action element
+
+        returns:  index of the element
+        """
+        i = self._index.get(elem)
+        if i is None:
+            # Double the arrays when they run out of space
+            if self._size == self._cap:
+                self._cap *= 2
+                self._Q = np.concatenate((self._Q, np.zeros(self._cap - self._size)))
+                self._N = np.concatenate((self._N, np.zeros(self._cap - self._size, dtype=np.int64)))
+
+            i = self._size
+            self._index[elem] = i
+            self._Q[i] = 0
+            self._N[i] = 1
+            self._size += 1
+
+        return i
+
+    def _elements(self, action):
+        """Returns the indices of the elements of an action, caching the result so each
+        action is split only once. Indices are stable, so the cache only grows when an
+        unseen action arrives.
 
         params
         str action: an action
 
-        returns:    UCB score of the action
+        returns:    array with the index of each action element
         """
-        return self._c * np.sqrt(np.log(self._t) / self._N[action])
+        idx = self._idx_cache.get(action)
+        if idx is None:
+            idx = np.array([self._intern(elem) for elem in action.split()], dtype=np.int64)
+            self._idx_cache[action] = idx
+
+        return idx
 
     def select(self, actions):
         """Selects an action from the set of available actions that maximizes
@@ -148,29 +307,33 @@ class UCB(ThoughtSelector):
         # Safe processing
         actions = self._preprocess(actions)
 
-        action_scores = []
-        for action in actions:
+        # Actions without elements cannot be scored, so they are never selected
+        names = [action for action in actions if self._elements(action).size > 0]
+        if not names:
+            raise ValueError("No actions with elements to select from")
 
-            # Compute UCB score for each element of the action
-            score = []
-            for elem in action.split():
+        # Stack the elements of all actions into an (actions x elements) index matrix padded with -1
+        elems = [self._elements(action) for action in names]
+        idx = np.full((len(elems), max(action_elems.size for action_elems in elems)), -1, dtype=np.int64)
+        for row, action_elems in enumerate(elems):
+            idx[row, :action_elems.size] = action_elems
+        mask = idx >= 0
 
-                # Add unseen elements to table
-                if elem not in self._Q:
-                    self._Q[elem] = 0
-                    self._N[elem] = 0
+        # Grow the scores buffer if there are more actions than ever before
+        if len(names) > self._score_buf.size:
+            self._score_buf = np.empty(max(len(names), 2 * self._score_buf.size))
 
-                # Score action
-                if self._N[elem] == 0:
-                    score += [np.inf]  # ensures all actions are sampled at least once
-                else:
-                    score += [self._Q[elem] + self._uncertainty(elem)]
+        # Compute UCB score once for each distinct element
+        unique, inverse = np.unique(idx[mask], return_inverse=True)
+        scores = self._Q[unique] + self._c * np.sqrt(self._log_t / self._N[unique])
+        idx[mask] = inverse
 
-            # Convert element-scores into action score
-            action_scores.append((action, np.mean(score)))
+        # Convert element-scores into action scores
+        action_scores = _mean_scores(scores, idx, self._score_buf[:len(names)])
 
-        # Greedy selection
-        selected_action, _ = max(action_scores, key=lambda x: x[1])
+        # Greedy selection, breaking ties (e.g. between unseen actions) at random
+        candidates = np.flatnonzero(action_scores == action_scores.max())
+        selected_action = names[random.choice(candidates)]
 
         # Safe processing
         thought_type, thought_info = self._postprocess(actions, selected_action)
@@ -187,23 +350,37 @@ class UCB(ThoughtSelector):
 
         returns: None
         """
-        # Update value estimates
-        for elem in action.split():
-            self._N[elem] += 1
-            self._Q[elem] = self._Q[elem] + (reward - self._Q[elem]) / self._N[elem]
+        # Update value estimates, the pseudo-count only counts for the uncertainty
+        # so the first reward replaces the initial value
+        for i in self._elements(action):
+            self._N[i] += 1
+            self._Q[i] += (reward - self._Q[i]) / (self._N[i] - 1)
 
         # Update exploration constant
         self._t += 1
+        self._log_t = math.log(self._t)
         self._c = max(self._c - self._decay, 0)
 
-    def reward_thought(self):
+    def reward_thought(self, brain_response=None):
         """Rewards the last thought phrased by the replier by updating its
         utility estimate with the relative improvement of the brain as
         a result of the user response (i.e. a reward).
 
+        params
+        dict brain_response: brain response to the user statement, to reuse the brain
+                             counts already gathered for it (e.g. by calculate_brain_statistics)
+
         returns: None
         """
-        brain_state = self._state_evaluator.evaluate_brain_state()
+        # Share the brain counts of this response with calculate_brain_statistics. Mentions
+        # carry no statement, so their brain state is evaluated from scratch and the counts
+        # of an earlier response are dropped
+        if brain_response is not None and 'statement' in brain_response:
+            self._state_evaluator._set_response(brain_response)
+            brain_state = self._state_evaluator.evaluate_brain_state(memoize=True)
+        else:
+            self._state_evaluator.invalidate()
+            brain_state = self._state_evaluator.evaluate_brain_state()
         self._log.info(f"Brain state: {brain_state}")
         self._state_history.append(brain_state)
 
@@ -221,34 +398,40 @@ class UCB(ThoughtSelector):
 
     # Plotting
 
-    def plot(self, max_bars=16, filename=None):
+    def plot(self, max_bars=16, filename=None, sort_by="uncertainty"):
         """Plots the value estimates for each action and their associated
         uncertainties in a bar plot.
 
         params
-        float margin: Margin between bars
+        int max_bars: maximum number of actions to plot
+        str filename: filename to save the plot to (optional)
+        str sort_by:  plot the top actions by 'uncertainty' or by 'value'
 
         returns: None
         """
-        total_rewards = sum(self._N.values())  # empty value table?
-        if total_rewards == 0:
+        if sort_by not in ("uncertainty", "value"):
+            raise ValueError(f"Unsupported sort_by '{sort_by}', use 'uncertainty' or 'value'")
+
+        import matplotlib.pyplot as plt
+
+        if self._size == 0:  # empty value table?
             print("WARNING Cannot plot empty value table")
             return
 
         # Estimate value/uncertainty of actions
-        a, q, u = [], [], []
-        for action in sorted(list(self._Q.keys())):
-            if self._N[action] > 0:
-                a += [action]
-                q += [self._Q[action]]
-                u += [self._uncertainty(action)]
-
-        # Reduce number of bars if > max_bars
+        elems = sorted(self._index.items())
+        a = [action for action, _ in elems]
+        idx = np.array([i for _, i in elems])
+        q = self._Q[idx]
+        u = self._uncertainty(self._log_t)[idx]
+
+        # Reduce number of bars to the top max_bars actions
         if len(a) > max_bars:
-            idx = random.sample(range(len(a)), max_bars)  # TODO: Top not random
+            key = u if sort_by == "uncertainty" else q
+            idx = np.sort(np.argpartition(-key, max_bars)[:max_bars])
             a = [a[i] for i in idx]
-            q = list(np.array(q)[idx])
-            u = list(np.array(u)[idx])
+            q = q[idx]
+            u = u[idx]
 
         # Draw barplots for U and Q
         fig = plt.figure(figsize=(10, 5), tight_layout=True)
@@ -273,59 +456,113 @@ class UCB(ThoughtSelector):
 
 
 class BrainEvaluator(object):
+    # Count based metrics, graph metrics would export and parse the full brain every turn
+    _METRICS = ('Total triples', 'Ratio claims to triples', 'Ratio perspectives to claims', 'Ratio conflicts to claims')
+
     def __init__(self, brain, main_graph_metric):
         """ Create an object to evaluate the state of the brain according to different graph metrics.
         The graph can be evaluated by a single given metric, or a full set of pre established metrics
         """
+        if main_graph_metric not in self._METRICS:
+            raise ValueError(f"Unsupported metric '{main_graph_metric}', use one of {', '.join(self._METRICS)}")
+
         self._brain = brain
         self.metric = main_graph_metric
 
-    def brain_as_graph(self):
-        # Take brain from previous episodes
-        graph = ConjunctiveGraph()
-        graph.parse(data=self._brain._connection.export_repository(), format='trig')
+        # Brain counts memoized for the last brain response, queried on demand
+        self._snapshot = dict()
+        self._response = None
+
+    def _set_response(self, brain_response):
+        """Drops the memoized counts when a new brain response arrives. Turn numbers restart
+        in every chat, so responses are told apart by identity rather than by turn.
+
+        params
+        dict brain_response: response of the brain to the last utterance
+
+        returns: None
+        """
+        if brain_response is not self._response:
+            self._snapshot = dict()
+            self._response = brain_response
 
-        return graph
+    def _count(self, name, memoize=False):
+        """Queries the brain for one of the counts the metrics are based on.
 
-    def brain_as_netx(self):
-        # Take brain from previous episodes
-        netx = rdflib_to_networkx_multidigraph(self.brain_as_graph())
+        params
+        str name:     'triples', 'statements', 'perspectives' or 'sources'
+        bool memoize: reuse (and store) the count gathered for the last brain response
 
-        return netx
+        returns: the count
+        """
+        if memoize and name in self._snapshot:
+            return self._snapshot[name]
+
+        if name == 'triples':
+            count = self._brain.count_triples()
+        elif name == 'statements':
+            count = self._brain.count_statements()
+        elif name == 'perspectives':
+            count = self._brain.count_perspectives()
+        elif name == 'sources':
+            count = self._brain.count_friends()
+        else:
+            raise ValueError(f"Unknown brain count: {name}")
 
-    def evaluate_brain_state(self):
-        brain_state = None
+        if memoize:
+            self._snapshot[name] = count
+
+        return count
 
-        ##### Group A #####
-        # if metric == 'Average degree':
-        #     brain_state = get_avg_degree(self.brain_as_netx())
-        # elif metric == 'Sparseness':
-        #     brain_state = get_sparseness(self.brain_as_netx())
-        # elif metric == 'Shortest path':
-        #     brain_state = get_shortest_path(self.brain_as_netx())
+    def _conflicts(self, memoize=False):
+        """Counts the negation conflicts in the brain. This is the most expensive
+        query, so it is kept apart from the other counts and only run when needed.
+
+        params
+        bool memoize: reuse (and store) the count gathered for the last brain response
+
+        returns: number of negation conflicts
+        """
+        if memoize and 'conflicts' in self._snapshot:
+            return self._snapshot['conflicts']
+
+        conflicts = len(self._brain.get_all_negation_conflicts())
+        if memoize:
+            self._snapshot['conflicts'] = conflicts
+
+        return conflicts
+
+    def evaluate_brain_state(self, memoize=False):
+        """Evaluates the brain according to the main metric, querying only the counts it needs.
+
+        params
+        bool memoize: reuse the counts gathered for the last brain response
+
+        returns: brain state
+        """
+        brain_state = None
 
-        ##### Group B #####
         if self.metric == 'Total triples':
-            brain_state = self._brain.count_triples()
-        elif self.metric == 'Average population':
-            brain_state = get_avg_population(self.brain_as_graph())
+            brain_state = self._count('triples', memoize)
 
-        ##### Group C #####
+        # Avoid zero division for empty brains
         elif self.metric == 'Ratio claims to triples':
-            brain_state = self._brain.count_statements() / self._brain.count_triples()
+            triples = self._count('triples', memoize) or 0.0000001
+            brain_state = self._count('statements', memoize) / triples
         elif self.metric == 'Ratio perspectives to claims':
-            if self._brain.count_statements() != 0:
-                brain_state = self._brain.count_perspectives() / self._brain.count_statements()
-            else:
-                brain_state = self._brain.count_perspectives() / 0.0000001
+            claims = self._count('statements', memoize) or 0.0000001
+            brain_state = self._count('perspectives', memoize) / claims
         elif self.metric == 'Ratio conflicts to claims':
-            if self._brain.count_statements() != 0:
-                brain_state = len(self._brain.get_all_negation_conflicts()) / self._brain.count_statements()
-            else:
-                brain_state = len(self._brain.get_all_negation_conflicts()) / 0.0000001
+            claims = self._count('statements', memoize) or 0.0000001
+            brain_state = self._conflicts(memoize) / claims
 
         return brain_state
 
+    def invalidate(self):
+        """Drops the cached brain counts, e.g. after the brain was edited."""
+        self._snapshot = dict()
+        self._response = None
+
     @staticmethod
     def compare_brain_states(current_state, prev_state):
         # TODO standardize according to metric
@@ -339,6 +576,7 @@ class BrainEvaluator(object):
     def calculate_brain_statistics(self, brain_response):
         # Grab the thoughts
         thoughts = brain_response['thoughts']
+        self._set_response(brain_response)
 
         # Gather basic stats
         stats = {
@@ -357,13 +595,13 @@ class BrainEvaluator(object):
             if thoughts['_overlaps']['_complement'] else 0,
             'trust': thoughts['_trust'],
 
-            'Total triples': self._brain.count_triples(),
+            'Total triples': self._count('triples', memoize=True),
             # 'Total classes': len(self._brain.get_classes()),
             # 'Total predicates': len(self._brain.get_predicates()),
-            'Total claims': self._brain.count_statements(),
-            'Total perspectives': self._brain.count_perspectives(),
-            'Total conflicts': len(self._brain.get_all_negation_conflicts()),
-            'Total sources': self._brain.count_friends(),
+            'Total claims': self._count('statements', memoize=True),
+            'Total perspectives': self._count('perspectives', memoize=True),
+            'Total conflicts': self._conflicts(memoize=True),
+            'Total sources': self._count('sources', memoize=True),
         }
 
         # Compute composite stats